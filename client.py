@@ -1,36 +1,140 @@
 import sys
 import os
-import json
+import orjson
+import time
 import asyncio
+import hashlib
+import re
+import io
+import functools
+import threading
 from dotenv import load_dotenv
 from contextlib import AsyncExitStack
-from typing import cast, List, Dict, Any
+from typing import cast, List, Dict, Any, Tuple, Optional, Awaitable
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
 import pyttsx3
 import speech_recognition as sr
+from faster_whisper import WhisperModel
 from gtts import gTTS
 import pygame
-import time
-import tempfile
 
 
 # Load environment variables
 load_dotenv()
 
+# Synthesized speech is cached on disk by text hash so repeated phrases skip gTTS
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".tts_cache")
+
+# How often to check whether playback finished (non-blocking, on the event loop)
+PLAYBACK_POLL_INTERVAL = 0.05
+
+# Streamed answers are flushed to TTS at sentence boundaries
+SENTENCE_END = re.compile(r"[.!?]\s")
+
+# Tool observations longer than this are truncated before entering memory
+TOOL_RESULT_MAX_CHARS = 2000
+
+# Local speech recognition (faster-whisper); int8 on CPU, int8_float16 on CUDA
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small.en")
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "cpu")
+
+# Trivial playback commands map straight to one tool call, skipping the LLM.
+# normalized query -> (tool name, arguments, spoken confirmation)
+INTENTS: Dict[str, Tuple[str, Dict[str, Any], str]] = {
+    "pause": ("pause_a_users_playback", {}, "Paused."),
+    "stop": ("pause_a_users_playback", {}, "Paused."),
+    "play": ("start_a_users_playback", {}, "Resuming playback."),
+    "resume": ("start_a_users_playback", {}, "Resuming playback."),
+    "continue": ("start_a_users_playback", {}, "Resuming playback."),
+    "next": ("skip_users_playback_to_next_track", {}, "Skipping to the next track."),
+    "skip": ("skip_users_playback_to_next_track", {}, "Skipping to the next track."),
+    "next song": ("skip_users_playback_to_next_track", {}, "Skipping to the next track."),
+    "previous": ("skip_users_playback_to_previous_track", {}, "Going back to the previous track."),
+    "previous song": ("skip_users_playback_to_previous_track", {}, "Going back to the previous track."),
+    "go back": ("skip_users_playback_to_previous_track", {}, "Going back to the previous track."),
+    "shuffle on": ("toggle_shuffle_for_users_playback", {"state": True}, "Shuffle is on."),
+    "shuffle off": ("toggle_shuffle_for_users_playback", {"state": False}, "Shuffle is off."),
+    "repeat on": ("set_repeat_mode_on_users_playback", {"state": "context"}, "Repeat is on."),
+    "repeat off": ("set_repeat_mode_on_users_playback", {"state": "off"}, "Repeat is off."),
+    "mute": ("set_volume_for_users_playback", {"volume_percent": 0}, "Muted."),
+}
+NON_WORD = re.compile(r"[^\w\s]")
+
+# Seconds to wait for speech to start on the speculative first listen
+FIRST_LISTEN_TIMEOUT = 10
+
+# Ping OpenAI after this many idle seconds to keep the pooled connection warm
+KEEPALIVE_INTERVAL = 30
+# Pings are best-effort: short timeout and no retries
+PING_TIMEOUT = 5
+
+@functools.lru_cache(maxsize=128)
+def synthesize(text: str) -> bytes:
+    # Repeated phrases ("Paused.", "Skipping to the next track.") are served from
+    # memory, backed by an on-disk cache keyed by text hash that survives restarts
+    path = os.path.join(TTS_CACHE_DIR, hashlib.blake2b(text.encode(), digest_size=16).hexdigest() + ".mp3")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    buf = io.BytesIO()
+    gTTS(text=text, lang='en').write_to_fp(buf)
+    audio = buf.getvalue()
+
+    # Write to a temp file and rename, so a partial file is never cached
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("TTS cache write failed:", e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return audio
+
 class SpotifyAgentClient:
-    def __init__(self, api_key: str, max_iterations: int = 5):
+    def __init__(self, api_key: str, max_iterations: int = 5, memory_window: int = 10):
         self.openai = AsyncOpenAI(api_key=api_key)
         self.exit_stack = AsyncExitStack()
         self.session: ClientSession | None = None
+        # Static prefix (system prompt) is kept byte-identical across turns so the
+        # provider-side prompt cache can reuse it; only dynamic turns go in memory
+        self._static_prefix: List[ChatCompletionMessageParam] = []
         self.memory: List[ChatCompletionMessageParam] = []
-        self.tool_defs: List[Dict[str, Any]] = []
+        self.tool_defs: Tuple[ChatCompletionToolParam, ...] = ()
         self.max_iterations = max_iterations
+        # Keep roughly the last memory_window messages verbatim; older turns are
+        # folded into a single summary message
+        self.memory_window = memory_window
+        self._compact_task: asyncio.Task | None = None
+        self._last_openai_call = 0.0
+        self._keepalive_task: asyncio.Task | None = None
+        self._ping_failing = False
+        # Set once connect() finishes, so run_agent can wait on an in-flight connect
+        self._connecting = False
+        self._connected = asyncio.Event()
         self.engine = pyttsx3.init()
+        # Whisper is loaded lazily by the first record_voice call, which runs in a
+        # worker thread, so the (possibly downloading) load overlaps connect()
+        self._asr: WhisperModel | None = None
+        self._asr_lock = threading.Lock()
+
+        # Initialize audio once
+        pygame.mixer.init(frequency=24000)  # gTTS produces 24 kHz MP3
 
     async def connect(self):
+        self._connecting = True
+        # Open the OpenAI TLS connection while the MCP server spawns
+        # (best-effort background task; connect() never waits on it)
+        self._keepalive_task = asyncio.create_task(self._keepalive())
+
         # Spawn the MCP server via stdio
         cmd = sys.executable
         args = ["-u", "server.py"]
@@ -41,136 +145,353 @@ class SpotifyAgentClient:
 
         # List and cache tools
         tools = (await self.session.list_tools()).tools
-        print("Connected! Available tools:")
-        for t in tools:
-            print(f"- {t.name}: {t.description}")
-        self.tool_defs = [
-            {"type": "function", "function": {"name": t.name, "description": t.description, "parameters": t.inputSchema}}
-            for t in tools
-        ]
-
-        # Initialize system prompt in memory
+        # Only a summary: the speculative first-utterance prompt is already on screen
+        print(f"Connected! {len(tools)} Spotify tools available.")
+        # Build the SDK-ready tools param once, frozen in a deterministic order
+        # (sorted by name) so it is passed unchanged and serializes identically
+        # on every request
+        self.tool_defs = tuple(
+            cast(ChatCompletionToolParam, {
+                "type": "function",
+                "function": {"name": t.name, "description": t.description or "", "parameters": dict(t.inputSchema)},
+            })
+            for t in sorted(tools, key=lambda t: t.name)
+        )
+
+        # Initialize the static system prompt (no timestamps or session ids here)
         system_prompt = (
             "You are a reasoning agent with access to Spotify tools. "
             "When needing Spotify actions (searching tracks, controlling playback, managing playlists), decide and call the correct function. "
             "Use a ReAct-style loop: think, act, observe, repeat until you have a final answer." 
             "The output generated should be easily read by an AI voice assistant. Do not include URLs or emojis in the output."
         )
-        self.memory.append({"role": "system", "content": system_prompt})
+        self._static_prefix = [{"role": "system", "content": system_prompt}]
+
+        self._connected.set()
 
-    async def run_agent(self, user_query: str) -> str:
+    async def _ping_openai(self):
+        # Cheap request that only serves to open/keep the HTTP connection
+        self._last_openai_call = time.monotonic()
+        try:
+            await self.openai.with_options(timeout=PING_TIMEOUT, max_retries=0).models.list()
+            self._ping_failing = False
+        except Exception as e:
+            # report once per outage, not on every keepalive tick
+            if not self._ping_failing:
+                print("[Agent] OpenAI warm-up failed:", e)
+            self._ping_failing = True
+
+    async def _keepalive(self):
+        await self._ping_openai()
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if time.monotonic() - self._last_openai_call >= KEEPALIVE_INTERVAL:
+                await self._ping_openai()
+
+    async def run_agent(self, user_query: str, sentences: Optional[asyncio.Queue] = None) -> str:
+        """Run the ReAct loop for one query. If a queue is given, the final answer
+        is streamed into it sentence by sentence as tokens arrive."""
+        try:
+            return await self._run_agent(user_query, sentences)
+        finally:
+            # Bound history size off the request path, once the answer is out
+            self._schedule_compaction()
+
+    async def _run_agent(self, user_query: str, sentences: Optional[asyncio.Queue]) -> str:
+        if self._connecting:
+            await self._connected.wait()
         if not self.session:
             raise RuntimeError("Not connected to MCP server")
 
+        # Known one-shot commands bypass the LLM entirely
+        intent = INTENTS.get(NON_WORD.sub("", user_query.lower()).strip())
+        if intent and await self._run_intent(*intent):
+            confirmation = intent[2]
+            self.memory.append({"role": "user", "content": user_query})
+            self.memory.append({"role": "assistant", "content": confirmation})
+            if sentences is not None:
+                sentences.put_nowait(confirmation)
+            return confirmation
+
         # Add user query to memory
         self.memory.append({"role": "user", "content": user_query})
 
         for iteration in range(self.max_iterations):
             # Agent thinks and optionally calls a tool
-            response = await self.openai.chat.completions.create(
-                model="gpt-4o",
-                messages=self.memory,
-                tools=cast(List[ChatCompletionToolParam], self.tool_defs),
-                tool_choice="auto",
-            )
-            msg = response.choices[0].message
-
-            # If agent chose a tool, execute it
-            if msg.tool_calls:
-                call = msg.tool_calls[0].function
-                func_name = call.name
-                args = json.loads(call.arguments or "{}")
-                print(f"[Agent] Iteration {iteration+1}: calling tool '{func_name}' with args {args}")
-                try:
-                    result = await self.session.call_tool(func_name, args)
-                    print(f"[Agent] Tool '{func_name}' returned: {result.content}")
-                    if hasattr(result, "content"):
-                        print(f"[Agent] Tool content:\n{result.content}")
-                    if getattr(result, "error", None):
-                        print(f"[Agent] Tool error details:\n{result}")
-                except Exception:
-                    import traceback
-                    print("[Agent] Exception during tool call:\n" + traceback.format_exc())
-                    raise
-
-                # Record the function call and its observation
-                self.memory.append({"role": "assistant", "name": func_name, "content": json.dumps(args)})
+            content, calls = await self._stream_completion(sentences)
+
+            # If agent chose tools, execute them (independent calls run concurrently)
+            if calls:
+                if len(calls) == 1:
+                    # same error handling as gather(..., return_exceptions=True)
+                    try:
+                        results: List[Any] = [await self._call_tool(iteration, calls[0])]
+                    except Exception as e:
+                        results = [e]
+                else:
+                    results = await asyncio.gather(
+                        *(self._call_tool(iteration, c) for c in calls),
+                        return_exceptions=True,
+                    )
+
+                # Record the tool calls and one observation per call
                 self.memory.append(cast(
                     ChatCompletionMessageParam,
-                    {
-                        "role": "function",
-                        "name": func_name,
-                        "content": result.content,
-                    }
+                    {"role": "assistant", "content": content or None, "tool_calls": calls},
                 ))
+                for c, result in zip(calls, results):
+                    if isinstance(result, BaseException):
+                        result_text = f"Tool call failed: {result}"
+                    else:
+                        result_text = self._tool_result_text(result)[:TOOL_RESULT_MAX_CHARS]
+                    self.memory.append({"role": "tool", "tool_call_id": c["id"], "content": result_text})
                 continue
 
             # No tool call: final answer
-            final_answer = msg.content or ""
-            self.memory.append({"role": "assistant", "content": final_answer})
-            return final_answer
+            self.memory.append({"role": "assistant", "content": content})
+            return content
 
         # Reached max iterations without final answer
-        return "I'm sorry, I couldn't complete the request."
+        fallback = "I'm sorry, I couldn't complete the request."
+        if sentences is not None:
+            sentences.put_nowait(fallback)
+        return fallback
+
+    async def _run_intent(self, tool_name: str, args: Dict[str, Any], confirmation: str) -> bool:
+        """Dispatch a routed command; False means fall back to the LLM."""
+        print(f"[Agent] Routed command: calling tool '{tool_name}' with args {args}")
+        try:
+            result = await self.session.call_tool(tool_name, args)
+        except Exception as e:
+            print(f"[Agent] Routed command failed: {e}")
+            return False
+        if getattr(result, "isError", False):
+            return False
+        # tools report HTTP failures as {"isError": true, ...} in their payload
+        try:
+            payload = orjson.loads(self._tool_result_text(result))
+        except orjson.JSONDecodeError:
+            return True
+        return not (isinstance(payload, dict) and payload.get("isError"))
+
+    def _schedule_compaction(self):
+        if len(self.memory) <= 2 * self.memory_window + 1:
+            return
+        if self._compact_task is None or self._compact_task.done():
+            self._compact_task = asyncio.create_task(self._compact_memory())
+
+    async def _compact_memory(self):
+        """Summarize everything but the last turns once memory exceeds the window."""
+        if len(self.memory) <= 2 * self.memory_window + 1:
+            return
+
+        # Cut at a user message so tool calls stay next to their results
+        cut = len(self.memory) - self.memory_window
+        while cut > 0 and self.memory[cut]["role"] != "user":
+            cut -= 1
+        if cut <= 1:
+            return
+
+        compacted = self.memory[:cut]
+        transcript = []
+        for m in compacted:
+            if m.get("tool_calls"):
+                names = ", ".join(c["function"]["name"] for c in m["tool_calls"])
+                transcript.append(f"assistant called tools: {names}")
+            if m.get("content"):
+                transcript.append(f"{m.get('name', m['role'])}: {m['content']}")
+        try:
+            response = await self.openai.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "Summarize this conversation between a user and a Spotify assistant. "
+                                                  "Keep facts needed to continue it (tracks, playlists, devices, preferences)."},
+                    {"role": "user", "content": "\n".join(transcript)},
+                ],
+            )
+        except Exception as e:
+            print("[Agent] Memory summarization failed:", e)
+            return
+
+        # New turns are only ever appended, so the summarized head is still in
+        # place unless memory was reset meanwhile
+        if any(a is not b for a, b in zip(self.memory[:cut], compacted)) or len(self.memory) < cut:
+            return
+        summary = response.choices[0].message.content or ""
+        self.memory[:cut] = [{"role": "system", "name": "summary", "content": summary}]
+
+    async def _stream_completion(self, sentences: Optional[asyncio.Queue]) -> Tuple[str, List[Dict[str, Any]]]:
+        """Stream one completion; returns the full content and any (fully buffered) tool calls."""
+        self._last_openai_call = time.monotonic()
+        stream = await self.openai.chat.completions.create(
+            model="gpt-4o",
+            messages=self._static_prefix + self.memory,
+            tools=self.tool_defs,
+            tool_choice="auto",
+            stream=True,
+        )
+
+        parts: List[str] = []
+        pending = ""
+        calls: Dict[int, Dict[str, Any]] = {}
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+
+            # Tool call arguments arrive in fragments; buffer them by index
+            for tc in delta.tool_calls or []:
+                call = calls.setdefault(tc.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                if tc.id:
+                    call["id"] = tc.id
+                if tc.function and tc.function.name:
+                    call["function"]["name"] += tc.function.name
+                if tc.function and tc.function.arguments:
+                    call["function"]["arguments"] += tc.function.arguments
+
+            if delta.content:
+                parts.append(delta.content)
+                if sentences is not None and not calls:
+                    pending += delta.content
+                    while (m := SENTENCE_END.search(pending)):
+                        sentences.put_nowait(pending[:m.end()].strip())
+                        pending = pending[m.end():]
+
+        if sentences is not None and not calls and pending.strip():
+            sentences.put_nowait(pending.strip())
+
+        for call in calls.values():
+            call["function"]["arguments"] = call["function"]["arguments"] or "{}"
+        return "".join(parts), [calls[i] for i in sorted(calls)]
+
+    async def _call_tool(self, iteration: int, tool_call: Dict[str, Any]) -> Any:
+        func_name = tool_call["function"]["name"]
+        try:
+            args = orjson.loads(tool_call["function"]["arguments"] or "{}")
+            print(f"[Agent] Iteration {iteration+1}: calling tool '{func_name}' with args {args}")
+            result = await self.session.call_tool(func_name, args)
+            print(f"[Agent] Tool '{func_name}' returned: {result.content}")
+            if getattr(result, "error", None):
+                print(f"[Agent] Tool error details:\n{result}")
+            return result
+        except Exception:
+            import traceback
+            print("[Agent] Exception during tool call:\n" + traceback.format_exc())
+            raise
+
+    @staticmethod
+    def _tool_result_text(result: Any) -> str:
+        # Flatten MCP content blocks into plain text for the model
+        parts = []
+        for item in getattr(result, "content", None) or []:
+            text = getattr(item, "text", None)
+            parts.append(text if text is not None else str(item))
+        return "\n".join(parts)
     
     
 
-    def speak(self, text: str):
+    async def speak(self, text: str, audio: Optional[Awaitable[bytes]] = None):
+        """Speak text; audio may be an already-started synthesis of it."""
         try:
             print(f"[Speak] Speaking: {text}")
-            tts = gTTS(text=text, lang='en')
+            # Synthesis blocks, so keep it off the event loop
+            if audio is None:
+                audio = asyncio.to_thread(synthesize, text)
+            await self._play(await audio)
+        except Exception as e:
+            print("Speech error:", e)
 
-            # Save to a file in the current directory
-            filename = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False, dir=".").name
-            tts.save(filename)
+    async def speak_stream(self, sentences: asyncio.Queue):
+        # Speak sentences as they are produced; None marks the end of the answer.
+        # Each sentence starts synthesizing as soon as it arrives, so the next one
+        # is usually ready by the time the current one finishes playing.
+        synthesized: asyncio.Queue = asyncio.Queue()
 
-            # Initialize and play using pygame
-            pygame.mixer.init()
-            pygame.mixer.music.load(filename)
-            pygame.mixer.music.play()
+        async def prefetch():
+            while (sentence := await sentences.get()) is not None:
+                synthesized.put_nowait((sentence, asyncio.create_task(asyncio.to_thread(synthesize, sentence))))
+            synthesized.put_nowait(None)
 
-            # Wait until the audio is done playing
-            while pygame.mixer.music.get_busy():
-                time.sleep(0.1)
+        prefetcher = asyncio.create_task(prefetch())
+        try:
+            while (item := await synthesized.get()) is not None:
+                await self.speak(*item)
+        finally:
+            prefetcher.cancel()
 
-        except Exception as e:
-            print("Speech error:", e)
+    @staticmethod
+    async def _play(audio: bytes):
+        pygame.mixer.music.load(io.BytesIO(audio), namehint="mp3")
+        pygame.mixer.music.play()
+        # Yield to the event loop until the mixer is done
+        while pygame.mixer.music.get_busy():
+            await asyncio.sleep(PLAYBACK_POLL_INTERVAL)
+
+    def _get_asr(self) -> WhisperModel:
+        with self._asr_lock:
+            if self._asr is None:
+                self._asr = WhisperModel(
+                    WHISPER_MODEL,
+                    device=WHISPER_DEVICE,
+                    compute_type="int8_float16" if WHISPER_DEVICE == "cuda" else "int8",
+                )
+            return self._asr
 
-    def record_voice(self) -> str:
+    def record_voice(self, timeout: Optional[float] = None) -> str:
+        # Load the model before prompting, so the user isn't kept waiting after speaking
+        self._get_asr()
         recognizer = sr.Recognizer()
         mic = sr.Microphone()
 
         print("Say something...")
         with mic as source:
             recognizer.adjust_for_ambient_noise(source)
-            audio = recognizer.listen(source)
+            try:
+                audio = recognizer.listen(source, timeout=timeout)
+            except sr.WaitTimeoutError:
+                return ""
 
-        try:
-            text = recognizer.recognize_google(audio)
-            print(f"You said: {text}")
-            return text
-        except sr.UnknownValueError:
-            print("Google Speech Recognition could not understand audio.")
+        # Transcribe locally; Whisper expects 16 kHz audio
+        wav = io.BytesIO(audio.get_wav_data(convert_rate=16000))
+        segments, _ = self._get_asr().transcribe(wav, vad_filter=True)
+        text = " ".join(s.text.strip() for s in segments).strip()
+        if not text:
+            print("Speech recognition could not understand audio.")
             return ""
-        except sr.RequestError as e:
-            print(f"Could not request results from Google Speech Recognition service; {e}")
-            return ""
-        
-    async def chat_loop(self):
+        print(f"You said: {text}")
+        return text
+
+    async def chat_loop(self, first_query: Optional[asyncio.Task] = None):
         print("Spotify Agent Chat (say 'quit' to exit)")
         while True:
-            #query = input("\n> ").strip()
-            query = self.record_voice().strip()
-            if not query or query.lower() == "quit":
+            if first_query is not None:
+                # First utterance was captured speculatively while connecting;
+                # if nothing was heard in time, just listen again
+                query = (await first_query).strip()
+                first_query = None
+                if not query:
+                    continue
+            else:
+                # Blocking input runs in a worker thread so background tasks keep running
+                #query = (await asyncio.to_thread(input, "\n> ")).strip()
+                query = (await asyncio.to_thread(self.record_voice)).strip()
+            if not query or query.lower().rstrip(".!?") == "quit":
                 break
+            sentences: asyncio.Queue = asyncio.Queue()
+            speaker = asyncio.create_task(self.speak_stream(sentences))
             try:
-                answer = await self.run_agent(query)
+                answer = await self.run_agent(query, sentences)
                 print("\n" + answer)
-                self.speak(answer)
             except Exception as e:
                 print("Error:", e)
+            finally:
+                sentences.put_nowait(None)
+                await speaker
 
     async def close(self):
+        for task in (self._keepalive_task, self._compact_task):
+            if task:
+                task.cancel()
         await self.exit_stack.aclose()
 
 async def main():
@@ -181,8 +502,18 @@ async def main():
 
     client = SpotifyAgentClient(api_key)
     try:
-        await client.connect()
-        await client.chat_loop()
+        # Listen for the first utterance while the MCP server and OpenAI connection
+        # start. connect() stays in this task because the stdio client's cancel
+        # scopes must be exited (in close()) by the task that entered them.
+        # The listen times out so a failed connect() can't leave the process
+        # waiting on the microphone thread at shutdown.
+        first_query = asyncio.create_task(asyncio.to_thread(client.record_voice, FIRST_LISTEN_TIMEOUT))
+        try:
+            await client.connect()
+        except Exception as e:
+            print("Could not connect to the Spotify MCP server:", e)
+            return
+        await client.chat_loop(first_query)
     finally:
         await client.close()
 
@@ -13,133 +13,251 @@ import os
 import sys
 import yaml
 import re
+import inspect
+import pickle
+import hashlib
+from collections import namedtuple
+import httpx
+import orjson
+from urllib.parse import urlencode
+from cachetools import TLRUCache
+from contextlib import asynccontextmanager
 
 from openapi_spec_validator import validate_spec
 from fastmcp import FastMCP
-from utils.auth import get_oauth_session
+from utils.auth import get_oauth_session, OAuth2SessionAuth
 
-# 1. Load and validate the OpenAPI spec
+# 1. Load and validate the OpenAPI spec. Validation and tool metadata are
+#    cached in a pickle keyed by the spec's content hash, so unchanged specs
+#    skip both on startup (the client spawns a fresh server per session)
 encoding = os.getenv("SPEC_ENCODING", "utf-8")
-with open("spotify-openapi.yaml", encoding=encoding) as f:
-    spec = yaml.safe_load(f)
-validate_spec(spec)
+with open("spotify-openapi.yaml", "rb") as f:
+    spec_bytes = f.read()
+spec_hash = hashlib.blake2b(spec_bytes, digest_size=16).hexdigest()
+SPEC_CACHE_VERSION = 2  # bump when the cached tool metadata layout changes
+spec_cache_file = f"spotify-openapi.{spec_hash}.v{SPEC_CACHE_VERSION}.pkl"
 
-# 2. Prepare OAuth2 session (auto-refresh) and HTTP client
+tool_specs = None
+try:
+    with open(spec_cache_file, "rb") as f:
+        cached_spec = pickle.load(f)
+    spec, tool_specs = cached_spec["spec"], cached_spec["tools"]
+except Exception:
+    spec = yaml.safe_load(spec_bytes.decode(encoding))
+    validate_spec(spec)
+
+# 2. Prepare OAuth2 session (auto-refresh) and one pooled HTTP/2 client
+#    shared by every tool, so calls reuse TLS/TCP connections
 oauth = get_oauth_session()
+auth = OAuth2SessionAuth(oauth)
+http = httpx.AsyncClient(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
 base_url = spec["servers"][0]["url"].rstrip("/")
 
-# 3. Instantiate FastMCP server instance
-mcp = FastMCP("Spotify MCP")
+# 3. Instantiate FastMCP server instance (closes the HTTP client on shutdown)
+@asynccontextmanager
+async def lifespan(server):
+    try:
+        yield
+    finally:
+        await http.aclose()
+
+mcp = FastMCP("Spotify MCP", lifespan=lifespan)
+
+# 4. Resolve $ref to real parameter definitions via a one-pass index of
+#    components/parameters (O(1) lookup per operation reference)
+PARAM_INDEX = {
+    f"#/components/parameters/{name}": param
+    for name, param in spec.get("components", {}).get("parameters", {}).items()
+}
 
-# 4. Resolve $ref to real parameter definitions
 def resolve_param(param):
     if "$ref" in param:
-        # Follow JSON Reference to components/parameters
-        parts = param["$ref"].lstrip("#/").split("/")
-        obj = spec
-        for key in parts:
-            obj = obj[key]
-        return obj
+        return PARAM_INDEX[param["$ref"]]
     return param
 
 # 5. Sanitize raw names into valid Python identifiers
+_SANITIZE = re.compile(r"[^0-9a-zA-Z_]")
+_LEADING_DIGIT = re.compile(r"^\d")
+
 def sanitize_name(name: str) -> str:
     # replace non-alphanumeric/underscore with underscore
-    sanitized = re.sub(r"[^0-9a-zA-Z_]", "_", name)
+    sanitized = _SANITIZE.sub("_", name)
     # prefix leading digits
-    if re.match(r"^\d", sanitized):
+    if _LEADING_DIGIT.match(sanitized):
         sanitized = f"op_{sanitized}"
     return sanitized
 
-# 6. Factory: create async tool functions with explicit args
-def make_tool_function(tool_name: str,
-                       path: str,
-                       method: str,
-                       param_objs: list,
-                       op: dict):
-    """
-    param_objs: list of dicts { 'name': <paramName>, 'in': 'path'|'query' }
-    op: the OpenAPI OperationObject (so we can see requestBody)
-    """
-    # split params
-    path_params  = [p["name"] for p in param_objs if p["in"] == "path"]
-    query_params = [p["name"] for p in param_objs if p["in"] == "query"]
-
-    # do we need a JSON body?
-    has_body = "requestBody" in op
-    all_args = path_params + query_params + (["body"] if has_body else [])
-
-    # signature
-    sig = ", ".join(all_args)
-    params_literal = ", ".join(f"'{p}': {p}" for p in query_params)
-
-    lines = []
-    lines.append(f"async def {tool_name}({sig}):")
-    # construct the URL
-    lines.append(f"    url = f\"{base_url}{path}\"")
-    lines.append("    try:")
-    # make the request call
-    call_args = []
-    if query_params:
-        call_args.append(f"params={{ {params_literal} }}")
+# 6. Cache GET responses with per-endpoint TTLs (seconds); first matching
+#    path-template prefix wins, anything else falls back to the default
+CACHE_TTLS = [
+    ("/me/player", 2),
+    ("/tracks", 24 * 3600),
+    ("/albums", 24 * 3600),
+    ("/artists", 24 * 3600),
+    ("/audio-features", 24 * 3600),
+    ("/audio-analysis", 24 * 3600),
+    ("/playlists", 60),
+]
+DEFAULT_CACHE_TTL = 30
+
+# values are (ttl, payload); each entry expires ttl seconds after insertion
+response_cache = TLRUCache(maxsize=512, ttu=lambda key, value, now: now + value[0])
+
+def cache_ttl(path: str) -> int:
+    for prefix, ttl in CACHE_TTLS:
+        if path.startswith(prefix):
+            return ttl
+    return DEFAULT_CACHE_TTL
+
+# Mutations also invalidate related collections outside their own family,
+# e.g. creating or editing a playlist changes GET /me/playlists
+RELATED_INVALIDATIONS = [
+    ("/playlists", ["/me/playlists", "/users"]),
+    ("/users", ["/me/playlists"]),
+]
+
+def _under(path: str, prefix: str) -> bool:
+    # match on a path-segment boundary: /playlists/abc is not under /playlists/ab
+    return path == prefix or path.startswith(prefix + "/")
+
+def invalidate_cache(url: str):
+    # drop cached reads of the same resource family, e.g.
+    # PUT /me/player/play -> /me/player*, POST /playlists/{id}/tracks -> /playlists/{id}*,
+    # plus any related collections listed above
+    path = url[len(base_url):]
+    prefixes = ["/".join(path.split("/")[:3])]
+    for mutated, related in RELATED_INVALIDATIONS:
+        if _under(path, mutated):
+            prefixes.extend(related)
+
+    get_prefix = f"GET {base_url}"
+    for key in list(response_cache.keys()):
+        cached_path = key[len(get_prefix):].split("?", 1)[0]
+        if key.startswith(get_prefix) and any(_under(cached_path, p) for p in prefixes):
+            response_cache.pop(key, None)
+
+# 7. Factory: create async tool functions with explicit args
+#    path_params/query_params: parameter names by location
+#    required: names of required params; has_body: operation takes a JSON requestBody
+ToolSpec = namedtuple(
+    "ToolSpec",
+    ["name", "path", "method", "path_params", "query_params", "required", "has_body", "summary"],
+)
+
+def make_tool_function(t: ToolSpec):
+    tool_name, path, method = t.name, t.path, t.method
+    path_params, query_params, required, has_body = t.path_params, t.query_params, t.required, t.has_body
+
+    ttl = cache_ttl(path)
+
+    async def tool(**kwargs):
+        url = base_url + path.format(**{k: kwargs[k] for k in path_params})
+        params = {k: kwargs[k] for k in query_params if kwargs.get(k) is not None}
+        json_body = kwargs.get("body") if has_body else None
+        cache_key = f"{method} {url}?{urlencode(sorted(params.items()))}"
+        if method == "GET":
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached[1]
+        try:
+            resp = await http.request(method, url, params=params or None, json=json_body, auth=auth)
+            resp.raise_for_status()
+            if method != "GET":
+                invalidate_cache(url)
+            # handle empty-body / 204 / 201
+            if resp.status_code == 201 or resp.status_code == 204 or not resp.content:
+                return {'isError': False, 'content': ["Sucessfully executed"]}
+            result = {
+                'isError': False,
+                'content': orjson.loads(resp.content)
+            }
+            if method == "GET":
+                response_cache[cache_key] = (ttl, result)
+            return result
+        except Exception as e:
+            # log full traceback + HTTP detail
+            logging.exception(f'[{tool_name}] HTTP call failed', exc_info=True)
+            # if this was an HTTPStatusError we can pull out status & body
+            response = getattr(e, 'response', None)
+            status = response is not None and response.status_code
+            body   = response is not None and response.text
+            error_text = f"HTTP {status}: {body}" if status else str(e)
+            return {
+                'isError': True,
+                'content': [
+                    { 'type': 'text', 'text': error_text }
+                ]
+            }
+
+    # expose explicit keyword args so FastMCP can build the input schema
+    sig_params = [
+        inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY,
+                          default=inspect.Parameter.empty if name in required else None)
+        for name in path_params + query_params
+    ]
     if has_body:
-        call_args.append("json=body")
-    call_args = ", " + ", ".join(call_args) if call_args else ""
-    lines.append(f"        resp = oauth.request({method!r}, url{call_args})")
-    lines.append("        resp.raise_for_status()")
-    lines.append("        # handle empty-body / 204 / 201")
-    lines.append("        if resp.status_code == 201 or resp.status_code == 204 or not resp.text:")
-    lines.append("            return {'isError': False, 'content': [\"Sucessfully executed\"]}")
-    lines.append("        return {")
-    lines.append("            'isError': False,")
-    lines.append("            'content': resp.json()")
-    lines.append("        }")
-    lines.append("    except Exception as e:")
-    lines.append("        # log full traceback + HTTP detail")
-    lines.append(f"        logging.exception('[{tool_name}] HTTP call failed', exc_info=True)")
-    lines.append("        # if this was an HTTPError we can pull out status & body")
-    lines.append("        status = getattr(e, 'response', None) and e.response.status_code")
-    lines.append("        body   = getattr(e, 'response', None) and e.response.text")
-    lines.append("        error_text = f\"HTTP {status}: {body}\" if status else str(e)")
-    lines.append("        return {")
-    lines.append("            'isError': True,")
-    lines.append("            'content': [")
-    lines.append("                { 'type': 'text', 'text': error_text }")
-    lines.append("            ]")
-    lines.append("        }")
-
-    # join & exec
-    fn_src = "\n".join(lines)
-
-    # print(fn_src)
-    # print("\n\n")
-    namespace = { "oauth": oauth, "base_url": base_url, "logging": logging }
-    exec(fn_src, namespace)
-    return namespace[tool_name]
+        sig_params.append(inspect.Parameter("body", inspect.Parameter.KEYWORD_ONLY, default=None))
+    tool.__name__ = tool.__qualname__ = tool_name
+    tool.__signature__ = inspect.Signature(sig_params)
+    return tool
 
 
 # Allowed HTTP methods
 HTTP_METHODS = {"get", "put", "post", "delete", "options", "head", "patch", "trace"}
 
-# 7. Iterate through all paths and register as tools
-for path, methods in spec.get("paths", {}).items():
-    for method, op in methods.items():
-        if method.lower() not in HTTP_METHODS or not isinstance(op, dict):
-            continue
-
-        raw_name = op.get("operationId") or f"{method}_{path.strip('/').replace('/', '_')}"
-        tool_name = sanitize_name(raw_name)
-
-        # collect resolved params
-        param_objs = []
-        for p in op.get("parameters", []):
-            p_obj = resolve_param(p)
-            if p_obj.get("in") in ("path", "query"):
-                param_objs.append({ "name": p_obj["name"], "in": p_obj["in"] })
-
-        # make & register
-        fn = make_tool_function(tool_name, path, method.upper(), param_objs, op)
-        mcp.add_tool(fn, name=tool_name, description=op.get("summary", ""))
+# 8. Collect tool metadata from all paths (only when not loaded from cache)
+def build_tool_specs() -> list:
+    specs = []
+    for path, methods in spec.get("paths", {}).items():
+        for method, op in methods.items():
+            if method.lower() not in HTTP_METHODS or not isinstance(op, dict):
+                continue
+
+            raw_name = op.get("operationId") or f"{method}_{path.strip('/').replace('/', '_')}"
+
+            # split resolved params by location
+            path_params, query_params, required = [], [], []
+            for p in op.get("parameters", []):
+                p_obj = resolve_param(p)
+                if p_obj.get("in") == "path":
+                    path_params.append(p_obj["name"])
+                    required.append(p_obj["name"])
+                elif p_obj.get("in") == "query":
+                    query_params.append(p_obj["name"])
+                    if p_obj.get("required", False):
+                        required.append(p_obj["name"])
+
+            specs.append(ToolSpec(
+                name=sanitize_name(raw_name),
+                path=path,
+                method=method.upper(),
+                path_params=tuple(path_params),
+                query_params=tuple(query_params),
+                required=frozenset(required),
+                has_body="requestBody" in op,
+                summary=op.get("summary", ""),
+            ))
+    return specs
+
+if tool_specs is None:
+    tool_specs = build_tool_specs()
+    try:
+        # store plain tuples so the pickle doesn't depend on this module's import name
+        with open(spec_cache_file, "wb") as f:
+            pickle.dump({"spec": spec, "tools": [tuple(t) for t in tool_specs]}, f)
+    except OSError:
+        logging.warning("Could not write spec cache %s", spec_cache_file, exc_info=True)
+else:
+    tool_specs = [ToolSpec(*t) for t in tool_specs]
+
+# 9. Make all tools first, then register them
+tool_functions = [make_tool_function(t) for t in tool_specs]
+for t, fn in zip(tool_specs, tool_functions):
+    mcp.add_tool(fn, name=t.name, description=t.summary)
 
 
 if __name__ == "__main__":
@@ -4,10 +4,24 @@ import os
 # ⚠️ Only for local/dev testing! Do NOT use in production.
 os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-import json
+import orjson
+import time
+import logging
+import asyncio
+import tempfile
+import threading
+import httpx
+from contextlib import contextmanager
+from pathlib import Path
 from dotenv import load_dotenv
 from requests_oauthlib import OAuth2Session
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 load_dotenv()
 
 CLIENT_ID     = os.getenv("SPOTIFY_CLIENT_ID")
@@ -17,17 +31,69 @@ TOKEN_URL     = "https://accounts.spotify.com/api/token"
 AUTH_URL      = "https://accounts.spotify.com/authorize"
 SCOPE         = ["user-read-playback-state", "user-modify-playback-state"]
 TOKEN_FILE    = os.getenv("TOKEN_FILE", "spotify_token.json")
+REFRESH_AHEAD = 60  # seconds before expiry to refresh in the background
+REFRESH_TIMEOUT = 10  # seconds; the refresh runs under the cross-process lock
 
-def save_token(token: dict):
-    with open(TOKEN_FILE, "w") as f:
-        json.dump(token, f)
+# In-process copy of the token file; updated whenever a token is saved
+_TOKEN_CACHE: dict | None = None
 
-def load_token() -> dict:
+@contextmanager
+def _token_lock(exclusive: bool):
+    # Cross-process lock on a sidecar file, so concurrent server starts never
+    # read a half-written token or overwrite a freshly refreshed one
+    with open(f"{TOKEN_FILE}.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            # msvcrt has no shared locks; lock the first byte exclusively
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _read_token_file() -> dict:
     try:
-        return json.load(open(TOKEN_FILE))
+        return orjson.loads(Path(TOKEN_FILE).read_bytes())
     except FileNotFoundError:
         return {}
 
+def _write_token(token: dict):
+    # caller holds the exclusive token lock
+    global _TOKEN_CACHE
+    path = Path(TOKEN_FILE)
+    # write to a temp file in the same directory, then atomically swap it in
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(token))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    _TOKEN_CACHE = token
+
+def save_token(token: dict):
+    with _token_lock(exclusive=True):
+        _write_token(token)
+
+def load_token() -> dict:
+    global _TOKEN_CACHE
+    if _TOKEN_CACHE is not None:
+        return _TOKEN_CACHE
+    with _token_lock(exclusive=False):
+        token = _read_token_file()
+    if token:
+        _TOKEN_CACHE = token
+    return token
+
 def get_oauth_session():
 
     extra = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET}
@@ -53,3 +119,95 @@ def get_oauth_session():
         )
         save_token(token)
     return oauth
+
+
+class OAuth2SessionAuth(httpx.Auth):
+    """httpx auth flow backed by an OAuth2Session's token.
+
+    The token is refreshed inline once expired or on a 401; when it is about to
+    expire, async requests schedule a background refresh instead of waiting.
+    """
+
+    def __init__(self, oauth: OAuth2Session):
+        self.oauth = oauth
+        self._lock = threading.Lock()
+        self._refresh_task: asyncio.Task | None = None
+
+    def _expires_in(self) -> float:
+        expires_at = (self.oauth.token or {}).get("expires_at")
+        return expires_at - time.time() if expires_at else float("inf")
+
+    def _refresh(self, only_if_expiring: bool = False, signed_with: str | None = None):
+        """Refresh the token unless someone else already did.
+
+        Holds the cross-process lock around re-read -> check -> refresh -> save, so
+        concurrent server processes refresh once and share the result.
+        only_if_expiring: skip if the (possibly re-read) token is not close to expiry
+        signed_with: access token a rejected request used; skip if it has since changed
+        """
+        global _TOKEN_CACHE
+        with self._lock, _token_lock(exclusive=True):
+            # adopt a newer token another process refreshed meanwhile
+            on_disk = _read_token_file()
+            current = self.oauth.token or {}
+            if on_disk.get("access_token") and on_disk.get("expires_at", 0) > current.get("expires_at", 0):
+                self.oauth.token = on_disk
+                _TOKEN_CACHE = on_disk
+
+            if only_if_expiring and self._expires_in() >= REFRESH_AHEAD:
+                return
+            if signed_with is not None and self.oauth.access_token != signed_with:
+                return
+            extra = {"client_id": CLIENT_ID, "client_secret": CLIENT_SECRET}
+            # bounded: other processes wait on the lock while this runs
+            token = self.oauth.refresh_token(TOKEN_URL, timeout=REFRESH_TIMEOUT, **extra)
+            _write_token(token)
+
+    @staticmethod
+    def _log_refresh_result(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logging.error("Background token refresh failed", exc_info=task.exception())
+
+    def _schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(
+                asyncio.to_thread(self._refresh, only_if_expiring=True)
+            )
+            self._refresh_task.add_done_callback(self._log_refresh_result)
+
+    def _can_retry(self, response) -> bool:
+        return response.status_code == 401 and bool(self.oauth.token.get("refresh_token"))
+
+    def _sign(self, request) -> str:
+        access_token = self.oauth.access_token
+        request.headers["Authorization"] = f"Bearer {access_token}"
+        return access_token
+
+    def auth_flow(self, request):
+        if self._expires_in() < 10:
+            self._refresh(only_if_expiring=True)
+        signed_with = self._sign(request)
+        response = yield request
+
+        # token revoked/expired server-side: refresh once (unless a concurrent
+        # request already did) and retry
+        if self._can_retry(response):
+            self._refresh(signed_with=signed_with)
+            self._sign(request)
+            yield request
+
+    async def async_auth_flow(self, request):
+        expires_in = self._expires_in()
+        if expires_in < 10:
+            await asyncio.to_thread(self._refresh, only_if_expiring=True)
+        elif expires_in < REFRESH_AHEAD:
+            self._schedule_refresh()
+        signed_with = self._sign(request)
+        response = yield request
+
+        # token revoked/expired server-side: refresh once (unless a concurrent
+        # request already did) and retry
+        if self._can_retry(response):
+            await asyncio.to_thread(self._refresh, signed_with=signed_with)
+            self._sign(request)
+            yield request